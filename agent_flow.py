@@ -1,78 +1,346 @@
+import asyncio
+import functools
 import operator
-from typing import TypedDict, Union, Dict, Any, List
+import os
+import re
+from typing import TypedDict, Union, Dict, Any, List, AsyncIterator, Optional, Tuple
 
 # Core LangChain and LangGraph imports
+# Structured output in langchain-core 0.1.x only accepts pydantic_v1 models
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langgraph.graph import StateGraph, END, START
 from langchain_community.utilities import SQLDatabase
+from jinja2 import StrictUndefined
+from jinja2.sandbox import SandboxedEnvironment
 from dotenv import load_dotenv
 load_dotenv()
 
 # Import our database manager utility
-from db_manager import ACTIVE_DATABASES
+import db_manager
+from db_manager import ACTIVE_DATABASES, MAX_ROWS_TO_SUMMARIZE, run_sql
+from sql_cache import ExactCache, SemanticCache, ResultCache
+from fast_router import match_fast_route
 
 # --- 1. Define the Agent's Structured Output Schema ---
 class AgentAction(BaseModel):
     database_name: str = Field(description="The database to use (must match ACTIVE_DATABASES keys).")
     sql_query: str = Field(description="Complete SQL statement for MySQL.")
     intent: str = Field(description="'read' (SELECT) or 'write' (INSERT/UPDATE/DELETE).")
+    answer_template: Optional[str] = Field(
+        None,
+        description="Only for 'read': a concise answer to the user as a Jinja template. "
+                    "`result` is the list of rows, each a tuple of column values in SELECT order: "
+                    "index into it (e.g. {{ result[0][0] }}) or loop over it, never print {{ result }} "
+                    "itself. Leave empty for 'write'."
+    )
 
 # --- 2. Initialize the LLM ---
 llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash", temperature=0)
 
-# --- 3. Define Agent Nodes ---
-def generate_sql_and_intent(state: dict) -> dict:
+# When enabled, read answers are rendered from the answer_template produced together
+# with the SQL, skipping the second LLM call. Set to "false" to always use the LLM.
+FUSED_ANSWER_ENABLED = os.getenv("FUSED_ANSWER_ENABLED", "true").lower() == "true"
+
+# Answer templates come from the LLM, so they are only rendered in a sandbox.
+TEMPLATE_ENV = SandboxedEnvironment(undefined=StrictUndefined)
+
+# An answer template that prints the raw rows instead of indexing into them.
+RAW_RESULT_RE = re.compile(r"\{\{\s*result\s*\}\}")
+
+# Queries asking for the SQL itself get it shown alongside the answer.
+SQL_ONLY_RE = re.compile(r"\bsql\s+query\b", re.I)
+
+# --- 3. Build the Prompts and Chains Once ---
+# The static instructions and the schema (fixed between /init calls) form the
+# prompt prefix and only the user query varies at the tail, so the rendered
+# prefix stays byte-identical across requests and provider prefix caching applies.
+SQL_SYSTEM_PROMPT = (
+    "You are a SQL agent. Output a JSON object with 'database_name', 'sql_query', 'intent', 'answer_template'.\n"
+    "Rules:\n"
+    "1. Use only one database from the list.\n"
+    "2. sql_query must be complete.\n"
+    "3. intent: 'read' for SELECT, 'write' for others.\n"
+    "4. answer_template: only for 'read', as described in its field.\n"
+    "Available databases (use lowercase names exactly as shown):\n"
+    "{db_info}"
+)
+
+SQL_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SQL_SYSTEM_PROMPT),
+    ("human", "User Query: {query}")
+])
+
+STRUCTURED_CHAIN = SQL_PROMPT | llm.with_structured_output(AgentAction)
+
+# Kept long and fully static: Gemini only caches prompt prefixes of 1024+ tokens,
+# so the instructions alone must clear that bar for the variable tail to reuse them.
+ANSWER_SYSTEM_PROMPT = """You are an expert at converting raw database results into concise natural language.
+
+You are the final step of a SQL assistant. A user asked a question in plain language, \
+another step translated it into a single MySQL statement, and that statement has already \
+been executed. You receive three things: the user's original question, the SQL that was \
+run, and the results it produced. Your job is to answer the user's question using only \
+those results.
+
+How the results are formatted:
+- Results of a SELECT are a Python-style list of tuples. Each tuple is one row, and the \
+values appear in the same order as the columns in the SELECT clause of the SQL statement. \
+Use the SQL to work out what each position in a tuple means.
+- Long results are truncated before they reach you. In that case only the first rows are \
+shown, followed by a note such as "(showing first 20 of 1000+ rows)". The note gives the \
+number of rows that were actually returned; a trailing "+" means there were at least that \
+many. Anything cut mid-way ends with "... (truncated)".
+- "No rows returned." means the query ran successfully and matched nothing.
+- For INSERT, UPDATE and DELETE statements the result is usually empty. An empty result for \
+a write means the statement ran without errors.
+- Dates, decimals and other values may appear as Python literals, for example \
+datetime.date(2024, 1, 31) or Decimal('12.50'). Present them in a natural form such as \
+2024-01-31 or 12.50.
+
+How to answer:
+1. Answer the question directly in the first sentence. If the user asked for a number, \
+lead with the number. If they asked for a list, give the list.
+2. Be concise. Prefer one short paragraph, or a short bulleted list when there are several \
+items. Do not restate the question and do not describe the steps you took.
+3. Use only the data in the results. Never invent rows, values, names or totals that are \
+not present, and never guess what truncated rows contain. When results are truncated, say \
+that you are showing the first rows and mention how many rows were returned.
+4. Do not perform long calculations across many rows. Simple observations such as the \
+highest value in a short list are fine; anything that would require rows you cannot see \
+is not.
+5. Keep numbers exactly as returned, apart from formatting. Keep currency symbols or units \
+only when the question or the column names make them clear.
+6. Refer to columns and tables with readable names (for example "total sales" rather than \
+total_sales) unless the user clearly expects the raw identifiers.
+7. If no rows were returned, say plainly that nothing matched the question. Do not \
+speculate about why unless the SQL makes the reason obvious, for example a filter on a \
+specific value.
+8. For write statements, confirm what was changed in one sentence, based on the SQL.
+9. If the results do not actually answer the question (for example the SQL selected \
+different columns than the user asked about), answer with what the results do show and \
+state briefly what is missing.
+10. Do not include the SQL statement in your answer and do not wrap the answer in code \
+blocks. The SQL is shown to the user separately when they ask for it.
+11. Do not add greetings, apologies, follow-up offers or closing remarks.
+12. Write in the same language as the user's question.
+
+Formatting:
+- Plain text with optional Markdown bullet lists. No headings and no tables unless the \
+user explicitly asked for a table.
+- When listing rows, show at most the rows you were given and keep each bullet to one line.
+- Round long decimal values to two places unless the user asked for more precision.
+
+Examples of good answers:
+- Question: "How many customers are there?" Results: [(1523,)]
+  Answer: There are 1,523 customers.
+- Question: "Top 3 products by revenue" Results: [('Laptop', Decimal('52000.00')), \
+('Phone', Decimal('31000.00')), ('Tablet', Decimal('12500.00'))]
+  Answer: The top 3 products by revenue are:
+  - Laptop: 52,000.00
+  - Phone: 31,000.00
+  - Tablet: 12,500.00
+- Question: "Orders placed on 2024-03-15" Results: No rows returned.
+  Answer: No orders were found for 2024-03-15.
+- Question: "Update the cost of product 'Laptop' to 1200" Results: (empty)
+  Answer: The cost of the product 'Laptop' was updated to 1200."""
+
+ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", ANSWER_SYSTEM_PROMPT),
+    ("human", "Original Query: {query}\nSQL Query: {sql}\nRaw Results: {result}")
+])
+
+ANSWER_CHAIN = ANSWER_PROMPT | llm
+
+# Bounds on the raw results placed in the answer prompt.
+ANSWER_MAX_ROWS = 20
+ANSWER_MAX_CHARS = 2000
+
+# Caches of generated actions for previously seen (or paraphrased) read queries.
+EXACT_CACHE = ExactCache()
+SEMANTIC_CACHE = SemanticCache()
+# Results of recent reads, so repeated identical SQL skips the database. Per-process:
+# other workers may serve pre-write results for up to the 60 s TTL.
+RESULT_CACHE = ResultCache()
+
+def truncate_rows(result: Union[str, List[tuple]], max_rows: int = ANSWER_MAX_ROWS, max_chars: int = ANSWER_MAX_CHARS) -> str:
     """
-    Node 1: Decide database, intent, and generate SQL.
-    Returns updated dict state.
+    Bounds a query result for the answer prompt: the first rows plus the
+    row count, cut to at most max_chars characters.
     """
-    print(f"\n[AGENT NODE] Deciding action for query: '{state['query']}'")
+    if isinstance(result, list):
+        if not result:
+            return "No rows returned."
+        snippet = str(result[:max_rows])
+        if len(result) > max_rows:
+            total = f"{len(result)}+" if len(result) >= MAX_ROWS_TO_SUMMARIZE else str(len(result))
+            snippet += f"\n(showing first {max_rows} of {total} rows)"
+    else:
+        snippet = result
 
-    # Gather schema info
-    db_info_list = []
-    for name, db in ACTIVE_DATABASES.items():
-        db_info_list.append(f"Database Name: {name}\nTables:\n{db.get_table_info()}")
-    db_info_str = "\n---\n".join(db_info_list)
+    if len(snippet) > max_chars:
+        snippet = snippet[:max_chars] + "... (truncated)"
+    return snippet
+
+@functools.lru_cache(maxsize=1024)
+def compile_answer_template(template: str):
+    """Compiles an answer template once, so cached actions reuse the compiled template."""
+    return TEMPLATE_ENV.from_string(template)
+
+def safe_render(template: str, result: List[tuple], **context: Any) -> Optional[str]:
+    """Renders a template against the rows, or returns None if it fails."""
+    try:
+        return compile_answer_template(template).render(result=result, **context)
+    except Exception as e:
+        # Any failure (syntax, bad indexing, type errors) means the template is unusable.
+        print(f"[EXECUTION NODE] Unusable answer template, falling back to LLM: {e}")
+        return None
 
-    # System prompt
-    system_prompt = f"""
-    You are a SQL agent. Output a JSON object with 'database_name', 'sql_query', 'intent'.
-    Available databases (use lowercase names exactly as shown):
-    {db_info_str}
-    Rules:
-    1. Use only one database from the list.
-    2. sql_query must be complete.
-    3. intent: 'read' for SELECT, 'write' for others.
+def render_answer_template(state: dict, result: Union[str, List[tuple]]) -> Optional[str]:
     """
+    Renders the answer_template generated with the SQL against the fetched rows.
+    Returns None when the fused path does not apply, so the caller falls back to the LLM.
+    """
+    template = state.get("answer_template")
+    if state.get("fast_routed"):
+        # Fast routes carry their own fixed templates. They handle any number of rows,
+        # but run_sql stops at MAX_ROWS_TO_SUMMARIZE, so a full result may be cut short.
+        if not isinstance(result, list):
+            return None
+        return safe_render(template, result, truncated=len(result) >= MAX_ROWS_TO_SUMMARIZE)
+    if not FUSED_ANSWER_ENABLED or state.get("intent") != "read" or state.get("sql_only_request"):
+        return None
+    # Only small results that were not truncated can be answered without the LLM.
+    if not isinstance(result, list) or len(result) > ANSWER_MAX_ROWS:
+        return None
+    # A template that never uses the result cannot be grounded in the data, and one
+    # that prints it whole would show the user a raw list of tuples.
+    if not template or "result" not in template or RAW_RESULT_RE.search(template):
+        return None
+    return safe_render(template, result)
+
+async def run_sql_cached(db_name: str, sql: str, intent: Optional[str]) -> Union[str, List[tuple]]:
+    """
+    Runs SQL off the event loop. Reads are served from RESULT_CACHE when possible,
+    and a write drops the cached results of its database.
+    """
+    schema_hash = db_manager.SCHEMA_STATE.schema_hash
+    if intent == "read":
+        cached = RESULT_CACHE.get(schema_hash, db_name, sql)
+        if cached is not None:
+            print("[EXECUTION NODE] Result cache hit, skipping database.")
+            return cached
+
+    # Query execution is blocking, keep it off the event loop
+    result = await asyncio.to_thread(run_sql, ACTIVE_DATABASES[db_name], sql, intent)
+
+    if intent == "read":
+        RESULT_CACHE.put(schema_hash, db_name, sql, result)
+    else:
+        RESULT_CACHE.invalidate(db_name)
+    return result
 
-    sql_only = "sql query" in state["query"].lower()
+def normalize_action(action: AgentAction) -> AgentAction:
+    """Normalizes the LLM's output once, so later steps can compare it directly."""
+    action.intent = action.intent.strip().lower()
+    action.database_name = action.database_name.strip().lower()
+    return action
 
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", system_prompt),
-        ("human", "User Query: {query}")
-    ]).partial(query=state["query"])
+# --- 4. Define Agent Nodes ---
+async def fast_route(state: dict) -> dict:
+    """
+    Node 0: Resolves trivial read queries (list tables, count rows, describe)
+    without calling the LLM. Other queries pass through unchanged.
+    """
+    if is_approved_resume(state):
+        return state
+
+    match = match_fast_route(state["query"], db_manager.SCHEMA_STATE.database_tables)
+    if match is None:
+        return state
+
+    db_name, sql_query, answer_template = match
+    print(f"[FAST ROUTE] Matched trivial query, skipping LLM. SQL: {sql_query}")
+    return {
+        "query": state["query"],
+        "sql_query": sql_query,
+        "database_name": db_name,
+        "response": "",
+        "intent": "read",
+        "verification_status": "approved",
+        "sql_only_request": False,
+        "answer_template": answer_template,
+        "fast_routed": True
+    }
+
+def is_approved_resume(state: dict) -> bool:
+    """True for a pending write re-entering the graph after human approval."""
+    return bool(state.get("sql_query")) and state.get("verification_status") == "approved"
+
+def route_query(state: dict) -> str:
+    """
+    Conditional routing: skip SQL generation for fast-routed queries and for
+    approved writes, which must execute the SQL the human actually reviewed.
+    """
+    if state.get("fast_routed") or is_approved_resume(state):
+        return "execute_sql"
+    return "agent_decision"
+
+async def generate_sql_and_intent(state: dict) -> dict:
+    """
+    Node 1: Decide database, intent, and generate SQL.
+    Returns updated dict state.
+    """
+    print(f"\n[AGENT NODE] Deciding action for query: '{state['query']}'")
+
+    sql_only = SQL_ONLY_RE.search(state["query"]) is not None
+
+    # Read once so the prompt and the cache key come from the same schema
+    schema = db_manager.SCHEMA_STATE
+    schema_hash = schema.schema_hash
 
     try:
-        structured_chain = prompt | llm.with_structured_output(AgentAction)
-        action: AgentAction = structured_chain.invoke({"query": state["query"]})
+        cached = EXACT_CACHE.get(state["query"], schema_hash)
+        if cached is None:
+            # A paraphrase match is not promoted into the exact cache: only queries
+            # the LLM actually answered are trusted as exact matches.
+            cached = await asyncio.to_thread(SEMANTIC_CACHE.get, state["query"], schema_hash)
+
+        if cached is not None:
+            print("[AGENT NODE] Cache hit, skipping LLM call.")
+            database_name, sql_query, intent, answer_template = cached
+            action = AgentAction(
+                database_name=database_name,
+                sql_query=sql_query,
+                intent=intent,
+                answer_template=answer_template
+            )
+        else:
+            # Schema info is precomputed at /init
+            action = normalize_action(await STRUCTURED_CHAIN.ainvoke({
+                "db_info": schema.prompt,
+                "query": state["query"]
+            }))
+            # Never cache writes, they must always be generated fresh for verification.
+            if action.intent != "write":
+                generated = (action.database_name, action.sql_query, action.intent, action.answer_template)
+                EXACT_CACHE.put(state["query"], schema_hash, generated)
+                await asyncio.to_thread(SEMANTIC_CACHE.put, state["query"], schema_hash, generated)
 
         print(f"[AGENT NODE] Generated Intent: {action.intent.upper()}")
         print(f"[AGENT NODE] Target DB: {action.database_name}")
         print(f"[AGENT NODE] Proposed SQL: {action.sql_query}")
 
-        # Normalize database name
-        db_name = action.database_name.strip().lower()
-
         new_state = {
             "query": state["query"],
             "sql_query": action.sql_query,
-            "database_name": db_name,
+            "database_name": action.database_name,
             "response": "",
-            "intent": action.intent.lower(),
-            "verification_status": "pending" if action.intent.lower() == "write" else "approved",
-            "sql_only_request": sql_only
+            "intent": action.intent,
+            "verification_status": "pending" if action.intent == "write" else "approved",
+            "sql_only_request": sql_only,
+            "answer_template": action.answer_template
         }
 
         return new_state
@@ -86,10 +354,22 @@ def generate_sql_and_intent(state: dict) -> dict:
             "response": f"Error: Could not generate SQL. Details: {e}",
             "intent": None,
             "verification_status": "failed",
-            "sql_only_request": sql_only
+            "sql_only_request": sql_only,
+            "answer_template": None
         })
         return new_state
 
+async def decide_action(state: dict) -> dict:
+    """
+    Runs the graph's decision steps (fast_route, then agent_decision when needed)
+    without executing anything, for callers that run the SQL themselves.
+    Route the result with requires_verification, as the graph does.
+    """
+    decided_state = await fast_route(state)
+    if route_query(decided_state) == "agent_decision":
+        decided_state = await generate_sql_and_intent(decided_state)
+    return decided_state
+
 def requires_verification(state: dict) -> str:
     """Conditional routing based on intent."""
     if state.get("intent") == "write" and state.get("verification_status") == "pending":
@@ -102,43 +382,65 @@ def requires_verification(state: dict) -> str:
         print("[CONDITIONAL EDGE] -> Operation failed or rejected.")
         return "end_with_response"
 
-def execute_sql_query(state: dict) -> dict:
-    """Node 2: Executes SQL and formats final answer."""
-    db_name = (state.get("database_name") or "").strip().lower()
+async def run_sql_for_answer(state: dict, node: str) -> Tuple[str, Optional[dict]]:
+    """
+    Runs the SQL of a decided state and prepares its answer, for both the graph
+    and the streaming endpoint. Returns (answer, None) when the answer is final
+    (an error or a rendered template), or (prefix, inputs) when ANSWER_CHAIN must
+    still be called with inputs and its output appended to prefix.
+    """
+    # Database names are normalized when the action is generated
+    db_name = state.get("database_name") or ""
     sql = state.get("sql_query")
 
-    print(f"\n[EXECUTION NODE] Running SQL against '{db_name}'...")
+    print(f"\n[{node}] Running SQL against '{db_name}'...")
 
     if not db_name or db_name not in ACTIVE_DATABASES:
-        state["response"] = f"Error: Database '{db_name}' not found."
-        return state
-
-    db = ACTIVE_DATABASES[db_name]
+        return f"Error: Database '{db_name}' not found.", None
 
     try:
-        result = db.run(sql)
-        print(f"[EXECUTION NODE] Query successful. Result: {result}")
+        result = await run_sql_cached(db_name, sql, state.get("intent"))
+        result_snippet = truncate_rows(result)
+        print(f"[{node}] Query successful. Result: {result_snippet}")
+    except Exception as e:
+        print(f"SQL Execution Error: {e}")
+        return f"Database Error: '{e}'\nSQL: {sql}", None
 
-        # Format final answer
-        answer_prompt = ChatPromptTemplate.from_messages([
-            ("system", "You are an expert at converting raw database results into concise natural language."),
-            ("human", f"Original Query: {state['query']}\nSQL Query: {sql}\nRaw Results: {result}")
-        ])
+    # Without a second LLM call when the template applies
+    answer = render_answer_template(state, result)
+    if answer is not None:
+        return answer, None
 
-        final_answer_chain = answer_prompt | llm
+    prefix = f"SQL Query:\n```sql\n{sql}\n```\n\nFinal Answer:\n" if state.get("sql_only_request") else ""
+    return prefix, {"query": state["query"], "sql": sql, "result": result_snippet}
 
-        if state.get("sql_only_request"):
-            final_response = f"SQL Query:\n```sql\n{sql}\n```\n\nFinal Answer:\n" + final_answer_chain.invoke({"query": state['query'], "sql": sql, "result": result}).content
-        else:
-            final_response = final_answer_chain.invoke({"query": state['query'], "sql": sql, "result": result}).content
+async def execute_sql_query(state: dict) -> dict:
+    """Node 2: Executes SQL and formats final answer."""
+    response, answer_inputs = await run_sql_for_answer(state, "EXECUTION NODE")
+    if answer_inputs is not None:
+        try:
+            response += (await ANSWER_CHAIN.ainvoke(answer_inputs)).content
+        except Exception as e:
+            print(f"SQL Execution Error: {e}")
+            response = f"Database Error: '{e}'\nSQL: {state.get('sql_query')}"
+
+    state["response"] = response
+    return state
 
-        state["response"] = final_response
-        return state
+async def stream_sql_answer(state: dict) -> AsyncIterator[str]:
+    """
+    Streaming variant of execute_sql_query.
+    Runs the SQL and yields the final answer chunk by chunk as the LLM decodes it.
+    """
+    response, answer_inputs = await run_sql_for_answer(state, "STREAM NODE")
+    if response:
+        yield response
+    if answer_inputs is None:
+        return
 
-    except Exception as e:
-        print(f"SQL Execution Error: {e}")
-        state["response"] = f"Database Error: '{e}'\nSQL: {sql}"
-        return state
+    async for chunk in ANSWER_CHAIN.astream(answer_inputs):
+        if chunk.content:
+            yield chunk.content
 
 def prepare_verification_message(state: dict) -> dict:
     """Node 3: Prepares message for human verification."""
@@ -153,14 +455,47 @@ def prepare_verification_message(state: dict) -> dict:
     state["response"] = message
     return state
 
-# --- 4. Build the LangGraph Workflow ---
+async def warm_up_llm() -> None:
+    """
+    Sends a tiny request so the first user query does not pay for
+    TLS and connection setup with the Gemini API.
+    """
+    try:
+        await llm.ainvoke("ping")
+        print("[WARM UP] LLM connection ready.")
+    except Exception as e:
+        print(f"[WARM UP] LLM warm-up failed: {e}")
+
+async def warm_up_sql_prompt() -> None:
+    """
+    Runs the SQL chain once with the current schema, priming the structured
+    output binding and the provider's prefix cache for the schema prompt.
+    The result is discarded and never cached.
+    """
+    try:
+        await STRUCTURED_CHAIN.ainvoke({"db_info": db_manager.SCHEMA_STATE.prompt, "query": "ping"})
+        print("[WARM UP] SQL prompt prefix primed.")
+    except Exception as e:
+        print(f"[WARM UP] SQL prompt warm-up failed: {e}")
+
+# --- 5. Build the LangGraph Workflow ---
 def build_agent_workflow():
     workflow = StateGraph(dict)
+    workflow.add_node("fast_route", fast_route)
     workflow.add_node("agent_decision", generate_sql_and_intent)
     workflow.add_node("execute_sql", execute_sql_query)
     workflow.add_node("verify_human", prepare_verification_message)
 
-    workflow.set_entry_point("agent_decision")
+    workflow.set_entry_point("fast_route")
+
+    workflow.add_conditional_edges(
+        "fast_route",
+        route_query,
+        {
+            "agent_decision": "agent_decision",
+            "execute_sql": "execute_sql"
+        }
+    )
 
     workflow.add_conditional_edges(
         "agent_decision",
@@ -1,8 +1,39 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Mapping, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from types import MappingProxyType
 from langchain_community.utilities import SQLDatabase
 from sqlalchemy.engine import Engine
 import sqlalchemy
+import hashlib
 import os
+import re
+import threading
+
+# Upper bound on threads used to connect to and reflect databases during /init.
+MAX_INIT_WORKERS = 16
+
+# Connection pool settings shared by every engine. Pre-ping replaces connections
+# the server has dropped, and recycling keeps them under MySQL's wait_timeout.
+POOL_SIZE = 10
+MAX_OVERFLOW = 20
+POOL_RECYCLE_SECONDS = 1800
+
+# Maximum number of rows fetched from a SELECT and passed on for summarization.
+MAX_ROWS_TO_SUMMARIZE = 1000
+
+# Statements that can be bounded with a trailing LIMIT.
+SELECT_START_RE = re.compile(r"^\s*(?:select|with|\()", re.I)
+# A LIMIT already at the end of the statement: LIMIT n, LIMIT offset, n or LIMIT n OFFSET m.
+TRAILING_LIMIT_RE = re.compile(r"\blimit\s+(?:\d+\s*,\s*)?(\d+)(?:\s+offset\s+\d+)?\s*$", re.I)
+# Locking clauses must come after LIMIT, so such statements are left untouched.
+LOCKING_CLAUSE_RE = re.compile(r"\b(?:for\s+update|for\s+share|lock\s+in\s+share\s+mode)\b", re.I)
+
+# Table info of each database keyed by database name. There is no expiry: /init clears
+# it and /refresh-schema drops the refreshed databases, which is the only time a
+# schema is re-reflected. Reflection runs in a thread pool, hence the lock.
+SCHEMA_CACHE: Dict[str, str] = {}
+SCHEMA_CACHE_LOCK = threading.Lock()
 
 # Pydantic model for database credentials (for FastAPI input)
 from pydantic import BaseModel, Field
@@ -14,6 +45,17 @@ class MySQLCredentials(BaseModel):
     password: str = Field(..., description="The MySQL user's password.")
     database: str = Field(..., description="The name of the database.")
 
+@dataclass(frozen=True, slots=True)
+class SchemaState:
+    """Prompt-ready schema of ACTIVE_DATABASES, rebuilt on /init and /refresh-schema."""
+    # Schema description of every database, as shown to the LLM.
+    prompt: str = ""
+    # Fingerprint of the prompt, used to invalidate cached SQL when the schema changes.
+    schema_hash: str = ""
+    # Table names of each database, used to route trivial queries. Read-only, like the
+    # rest of the state: frozen=True alone would still allow mutating a dict in place.
+    database_tables: Mapping[str, Tuple[str, ...]] = field(default_factory=lambda: MappingProxyType({}))
+
 def get_db_engine(credentials: MySQLCredentials) -> Engine:
     """
     Creates a SQLAlchemy engine for a single MySQL database.
@@ -24,14 +66,35 @@ def get_db_engine(credentials: MySQLCredentials) -> Engine:
             f"{credentials.password}@{credentials.host}/"
             f"{credentials.database}"
         )
-        engine = sqlalchemy.create_engine(connection_uri)
-        # Test the connection to ensure it's valid
-        engine.connect()
+        engine = sqlalchemy.create_engine(
+            connection_uri,
+            pool_size=POOL_SIZE,
+            max_overflow=MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=POOL_RECYCLE_SECONDS
+        )
+        # Test the connection to ensure it's valid, returning it to the pool afterwards
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.text("SELECT 1"))
         return engine
     except Exception as e:
         print(f" Error connecting to database '{credentials.database}': {e}")
         raise ValueError(f"Failed to connect to MySQL database: {e}")
 
+def connect_database(creds: MySQLCredentials) -> Optional[SQLDatabase]:
+    """
+    Connects to a single database, returning None if the connection fails.
+    """
+    db_name = creds.database.lower()
+    try:
+        engine = get_db_engine(creds)
+        db = SQLDatabase(engine=engine)
+        print(f" Connection successful for database '{db_name}'.")
+        return db
+    except ValueError as e:
+        print(f" Could not initialize database '{db_name}'. Skipping.")
+        return None
+
 def initialize_databases(db_list: List[MySQLCredentials]) -> Dict[str, SQLDatabase]:
     """
     Initializes a dictionary of LangChain SQLDatabase objects
@@ -41,24 +104,179 @@ def initialize_databases(db_list: List[MySQLCredentials]) -> Dict[str, SQLDataba
         raise ValueError("Must provide at least two databases.")
 
     print("---  Initializing databases from provided credentials ---")
-    
+
+    # Connecting and reflecting are I/O bound, so do all databases in parallel.
+    # map() keeps the results in the same order as db_list.
+    with ThreadPoolExecutor(max_workers=min(MAX_INIT_WORKERS, len(db_list))) as executor:
+        results = list(executor.map(connect_database, db_list))
+
     databases: Dict[str, SQLDatabase] = {}
-    
-    for creds in db_list:
-        db_name = creds.database.lower()
-        try:
-            engine = get_db_engine(creds)
-            db = SQLDatabase(engine=engine)
-            databases[db_name] = db
-            print(f" Connection successful for database '{db_name}'.")
-        except ValueError as e:
-            print(f" Could not initialize database '{db_name}'. Skipping.")
+    for creds, db in zip(db_list, results):
+        if db is not None:
+            databases[creds.database.lower()] = db
 
     if not databases:
         raise RuntimeError("No databases were successfully initialized.")
 
+    # Schemas are static between /init calls, so build the prompt string once here
+    # instead of reflecting every database on each query.
+    with SCHEMA_CACHE_LOCK:
+        SCHEMA_CACHE.clear()
+    update_schema_state(databases)
+
     return databases
 
+def refresh_schema(database_name: Optional[str] = None) -> None:
+    """
+    Re-reflects one database (or all of them) after a schema change
+    and rebuilds the schema prompt.
+    """
+    names = [database_name] if database_name else list(ACTIVE_DATABASES)
+    for name in names:
+        if name not in ACTIVE_DATABASES:
+            raise ValueError(f"Database '{name}' is not initialized.")
+
+    for name in names:
+        # SQLDatabase caches its table list, so rebuild it on the same engine.
+        ACTIVE_DATABASES[name] = SQLDatabase(engine=ACTIVE_DATABASES[name]._engine)
+        with SCHEMA_CACHE_LOCK:
+            SCHEMA_CACHE.pop(name, None)
+
+    update_schema_state(ACTIVE_DATABASES)
+    print(f" Schema refreshed for: {names}")
+
+def update_schema_state(databases: Dict[str, SQLDatabase]) -> None:
+    """
+    Rebuilds the schema prompt, its hash and the table index for the given databases.
+    """
+    global SCHEMA_STATE
+    prompt = build_schema_info(databases)
+    # Swapped in as a single object, so readers never see a prompt and hash that disagree.
+    SCHEMA_STATE = SchemaState(
+        prompt=prompt,
+        schema_hash=hashlib.sha256(prompt.encode()).hexdigest(),
+        database_tables=MappingProxyType({
+            name: tuple(db.get_usable_table_names()) for name, db in databases.items()
+        })
+    )
+
+def cached_schema(db: SQLDatabase, key: str) -> str:
+    """
+    Returns the table info of a database, reflecting it only on a cache miss.
+    """
+    with SCHEMA_CACHE_LOCK:
+        table_info = SCHEMA_CACHE.get(key)
+    if table_info is None:
+        table_info = db.get_table_info()
+        with SCHEMA_CACHE_LOCK:
+            SCHEMA_CACHE[key] = table_info
+    return table_info
+
+def build_schema_info(databases: Dict[str, SQLDatabase]) -> str:
+    """
+    Builds the schema description of every database, as shown to the LLM.
+    """
+    names = list(databases)
+    with ThreadPoolExecutor(max_workers=min(MAX_INIT_WORKERS, len(names) or 1)) as executor:
+        table_infos = list(executor.map(lambda name: cached_schema(databases[name], name), names))
+
+    return "\n---\n".join(
+        f"Database Name: {name}\nTables:\n{table_info}"
+        for name, table_info in zip(names, table_infos)
+    )
+
+def strip_outer_comments(sql: str) -> str:
+    """
+    Removes whitespace and comments (--, # and /* */) before the first and after
+    the last SQL token. Quoted strings and identifiers are skipped, so a "#" or
+    "--" inside a literal is kept. MySQL /*! */ and /*+ */ comments are code.
+    """
+    start, end = None, 0
+    i, n = 0, len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch in "'\"`":
+            j = i + 1
+            while j < n:
+                if sql[j] == "\\" and ch != "`":
+                    j += 2
+                elif sql[j] == ch and j + 1 < n and sql[j + 1] == ch:
+                    # A doubled quote is an escaped quote
+                    j += 2
+                elif sql[j] == ch:
+                    break
+                else:
+                    j += 1
+            start = i if start is None else start
+            i = end = min(j + 1, n)
+        elif ch == "#" or (sql.startswith("--", i) and (i + 2 == n or sql[i + 2].isspace())):
+            newline = sql.find("\n", i)
+            i = n if newline == -1 else newline
+        elif sql.startswith("/*", i) and not sql.startswith(("/*!", "/*+"), i):
+            close = sql.find("*/", i + 2)
+            i = n if close == -1 else close + 2
+        else:
+            if not ch.isspace():
+                start = i if start is None else start
+                end = i + 1
+            i += 1
+    return sql[start:end] if start is not None else ""
+
+def bound_read_query(sql: str, max_rows: int = MAX_ROWS_TO_SUMMARIZE) -> str:
+    """
+    Adds (or tightens) a trailing LIMIT on a SELECT so MySQL never sends
+    more than max_rows rows. Other statements are returned unchanged.
+
+    >>> bound_read_query("SELECT * FROM t LIMIT 5000 -- x")
+    'SELECT * FROM t LIMIT 1000'
+    >>> bound_read_query("SELECT * FROM t LIMIT 10 # note")
+    'SELECT * FROM t LIMIT 10'
+    >>> bound_read_query("SELECT * FROM t LIMIT 10 /* c */")
+    'SELECT * FROM t LIMIT 10'
+    >>> bound_read_query("SELECT * FROM t -- limit 5")
+    'SELECT * FROM t LIMIT 1000'
+    >>> bound_read_query("SELECT * FROM t WHERE tag = '#x'; -- done")
+    "SELECT * FROM t WHERE tag = '#x' LIMIT 1000"
+    """
+    # Trailing comments would hide a LIMIT from the regex, or swallow an appended one.
+    statement = sql
+    while True:
+        stripped = strip_outer_comments(statement).rstrip(";")
+        if stripped == statement:
+            break
+        statement = stripped
+    if not SELECT_START_RE.match(statement) or LOCKING_CLAUSE_RE.search(statement):
+        return sql
+
+    match = TRAILING_LIMIT_RE.search(statement)
+    if match is None:
+        return f"{statement} LIMIT {max_rows}"
+    if int(match.group(1)) <= max_rows:
+        return statement
+    return statement[:match.start(1)] + str(max_rows) + statement[match.end(1):]
+
+def run_sql(db: SQLDatabase, sql: str, intent: Optional[str]) -> Union[str, List[tuple]]:
+    """
+    Executes a SQL statement. Reads return at most MAX_ROWS_TO_SUMMARIZE rows;
+    writes return the output of SQLDatabase.run.
+    """
+    if intent != "read":
+        return db.run(sql)
+
+    # mysql-connector buffers every result client-side (SQLAlchemy has no server-side
+    # cursors for it), so the row cap has to be part of the query itself.
+    with db._engine.connect() as connection:
+        result = connection.execute(sqlalchemy.text(bound_read_query(sql)))
+        if not result.returns_rows:
+            return []
+        rows = result.fetchmany(MAX_ROWS_TO_SUMMARIZE)
+
+    return [tuple(row) for row in rows]
+
 # Global variable to hold our initialized databases and their tools.
 # This will be populated by the FastAPI endpoint.
-ACTIVE_DATABASES: Dict[str, SQLDatabase] = {}
\ No newline at end of file
+ACTIVE_DATABASES: Dict[str, SQLDatabase] = {}
+
+# Schema of ACTIVE_DATABASES, replaced as a whole on /init and /refresh-schema.
+# Read it as `db_manager.SCHEMA_STATE` so the latest value is always used.
+SCHEMA_STATE: SchemaState = SchemaState()
\ No newline at end of file
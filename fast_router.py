@@ -0,0 +1,76 @@
+import re
+from typing import Mapping, Optional, Tuple
+
+# Trivial questions with deterministic SQL, answered without calling the LLM.
+# Patterns match the whole query, so anything with extra conditions still goes to the LLM.
+# The optional "in <database>" suffix selects the database explicitly.
+# Each route carries (pattern, SQL, answer template); the answer template is rendered
+# against the fetched rows, so these queries skip the answer LLM call as well.
+# `truncated` is set when the rows hit the fetch cap, so counts read "at least".
+FAST_ROUTES = [
+    (
+        re.compile(r"^\s*(?:show|list)\s+(?:all\s+)?(?:the\s+)?tables(?:\s+in\s+(?P<database>[\w-]+))?\s*\??\s*$", re.I),
+        "SHOW TABLES",
+        "{% if result %}The database has {% if truncated %}at least {% endif %}{{ result | length }} tables: "
+        "{{ result | map('first') | join(', ') }}.{% else %}The database has no tables.{% endif %}"
+    ),
+    (
+        re.compile(
+            r"^\s*(?:count\s+(?:the\s+)?rows|how\s+many\s+rows\s+are\s+there)\s+(?:in|of)\s+(?:the\s+)?"
+            r"(?P<table>\w+)(?:\s+table)?(?:\s+in\s+(?P<database>[\w-]+))?\s*\??\s*$",
+            re.I
+        ),
+        "SELECT COUNT(*) FROM `{table}`",
+        "The {table} table has {{ result[0][0] }} rows."
+    ),
+    (
+        re.compile(
+            r"^\s*describe\s+(?:the\s+)?(?:table\s+)?(?P<table>\w+)(?:\s+table)?"
+            r"(?:\s+in\s+(?P<database>[\w-]+))?\s*\??\s*$",
+            re.I
+        ),
+        "DESCRIBE `{table}`",
+        "The {table} table has {% if truncated %}at least {% endif %}{{ result | length }} columns: "
+        "{{ result | map('first') | join(', ') }}."
+    ),
+]
+
+def match_fast_route(
+    query: str, database_tables: Mapping[str, Tuple[str, ...]]
+) -> Optional[Tuple[str, str, str]]:
+    """
+    Returns (database_name, sql_query, answer_template) for a trivial read query,
+    or None if the query must go through the LLM.
+    """
+    for pattern, sql_template, answer_template in FAST_ROUTES:
+        match = pattern.match(query)
+        if not match:
+            continue
+
+        database = (match.group("database") or "").lower() or None
+        if database is not None and database not in database_tables:
+            return None
+
+        table = match.groupdict().get("table")
+        if table is None:
+            # Without a table to look up, the database must be named explicitly.
+            return (database, sql_template, answer_template) if database else None
+
+        # Only route when exactly one database has the table; the name is taken
+        # from the schema, never from the query, so it cannot inject SQL.
+        candidates = [
+            (db_name, table_name)
+            for db_name, tables in database_tables.items()
+            if database is None or db_name == database
+            for table_name in tables
+            if table_name.lower() == table.lower()
+        ]
+        if len(candidates) != 1:
+            return None
+
+        db_name, table_name = candidates[0]
+        # The answer template is Jinja, so the name is substituted without str.format;
+        # it matched \w+ above, so it cannot open a Jinja tag either.
+        return db_name, sql_template.format(table=table_name), answer_template.replace("{table}", table_name)
+
+    return None
@@ -1,11 +1,24 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, List
+from typing import Optional, List, AsyncIterator
+import redis.asyncio as redis
+import asyncio
+import orjson
+import os
 import uuid
 
 # Import our custom modules
-from db_manager import MySQLCredentials, initialize_databases, ACTIVE_DATABASES
-from agent_flow import build_agent_workflow
+from db_manager import MySQLCredentials, initialize_databases, refresh_schema, ACTIVE_DATABASES
+from agent_flow import (
+    build_agent_workflow,
+    warm_up_llm,
+    warm_up_sql_prompt,
+    decide_action,
+    requires_verification,
+    prepare_verification_message,
+    stream_sql_answer
+)
 
 # --- Pydantic Schemas for API Endpoints ---
 class InitRequest(BaseModel):
@@ -30,6 +43,13 @@ class QueryRequest(BaseModel):
         description="Must be 'approved' to execute a pending write operation."
     )
 
+class RefreshSchemaRequest(BaseModel):
+    """Schema for refreshing database schemas after a DDL change."""
+    database: Optional[str] = Field(
+        None,
+        description="The database to refresh. All databases are refreshed when omitted."
+    )
+
 class AgentResponse(BaseModel):
     """Schema for the agent's response."""
     session_id: str = Field(
@@ -53,18 +73,55 @@ class AgentResponse(BaseModel):
 # --- FastAPI Application Setup ---
 app = FastAPI(
     title="Mini Agentic SQL Bot",
-    description="A LangGraph agent that interacts with multiple MySQL databases with human-in-the-loop verification."
+    description="A LangGraph agent that interacts with multiple MySQL databases with human-in-the-loop verification.",
+    default_response_class=ORJSONResponse
 )
 
-# Global store for active agent states awaiting human verification.
-AGENT_SESSIONS: Dict[str, dict] = {}
+# Agent states awaiting human verification are kept in Redis, so they expire on
+# their own and are shared by every worker process.
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_SECONDS = 900
+# Only the fields needed to resume a pending write are stored.
+SESSION_FIELDS = ("query", "sql_query", "database_name", "intent", "verification_status", "sql_only_request")
+
+redis_client = redis.from_url(REDIS_URL)
 AGENT_APP = None  # Will be initialized once the databases are ready
+# References to fire-and-forget tasks, so they are not garbage collected mid-run.
+BACKGROUND_TASKS: set = set()
+
+
+def run_in_background(coro) -> None:
+    """Schedules a coroutine without awaiting it."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+async def save_session(session_id: str, state: dict) -> None:
+    """Stores a pending agent state until it is approved, rejected or expires."""
+    payload = {field: state.get(field) for field in SESSION_FIELDS}
+    await redis_client.set(f"sess:{session_id}", orjson.dumps(payload), ex=SESSION_TTL_SECONDS)
+
+
+async def pop_session(session_id: str) -> Optional[dict]:
+    """Atomically fetches and removes a pending agent state, so it can only be resumed once."""
+    raw = await redis_client.getdel(f"sess:{session_id}")
+    if raw is None:
+        return None
+    state = orjson.loads(raw)
+    state["response"] = ""
+    return state
 
 
 @app.on_event("startup")
 async def startup_event():
     """Initializes the agent workflow at application startup."""
     global AGENT_APP
+    # The graph does not depend on the databases (schemas are passed in at query
+    # time), so it is compiled once here and reused across /init calls.
+    AGENT_APP = build_agent_workflow()
+    # Open the Gemini connection now instead of on the first user query
+    run_in_background(warm_up_llm())
     print("---  FastAPI server starting. Waiting for database initialization. ---")
 
 
@@ -74,15 +131,16 @@ async def init_databases(request: InitRequest):
     Initializes the agent's databases with the provided MySQL credentials.
     This must be called successfully before any queries.
     """
-    global ACTIVE_DATABASES, AGENT_APP
+    global ACTIVE_DATABASES
     try:
+        # Connecting and reflecting is blocking, keep it off the event loop
+        new_databases = await asyncio.to_thread(initialize_databases, request.databases)
         # --- FIX: Update ACTIVE_DATABASES in-place ---
-        new_databases = initialize_databases(request.databases)
         ACTIVE_DATABASES.clear()
         ACTIVE_DATABASES.update(new_databases)
 
-        # Compile the agent workflow
-        AGENT_APP = build_agent_workflow()
+        # The schema prompt only exists once databases are known, so prime it here
+        run_in_background(warm_up_sql_prompt())
 
         print(f"ACTIVE_DATABASES keys: {list(ACTIVE_DATABASES.keys())}")
         return "Databases initialized successfully. You can now send queries to the /ask endpoint."
@@ -90,6 +148,28 @@ async def init_databases(request: InitRequest):
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/refresh-schema", summary="Refresh Database Schemas", response_model=str)
+async def refresh_schemas(request: RefreshSchemaRequest):
+    """
+    Re-reads database schemas after tables were created, altered or dropped.
+    Cached SQL generated against the old schema is no longer used.
+    """
+    if not ACTIVE_DATABASES:
+        raise HTTPException(
+            status_code=400,
+            detail="Agent is not initialized. Please call the /init endpoint first."
+        )
+
+    database_name = request.database.lower() if request.database else None
+    try:
+        await asyncio.to_thread(refresh_schema, database_name)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    run_in_background(warm_up_sql_prompt())
+    return "Schema refreshed successfully."
+
+
 @app.post("/ask", summary="Query the Agent", response_model=AgentResponse)
 async def ask_agent(request: QueryRequest):
     """
@@ -103,7 +183,7 @@ async def ask_agent(request: QueryRequest):
 
     # --- Handle HIL approval ---
     if request.session_id and request.verification_status:
-        return handle_verification_request(request)
+        return await handle_verification_request(request)
 
     # --- Handle a new query ---
     if not request.query:
@@ -120,10 +200,10 @@ async def ask_agent(request: QueryRequest):
     }
 
     try:
-        final_state: dict = AGENT_APP.invoke(initial_state)
+        final_state: dict = await AGENT_APP.ainvoke(initial_state)
 
         if final_state.get("intent") == "write" and final_state.get("verification_status") == "pending":
-            AGENT_SESSIONS[new_session_id] = final_state
+            await save_session(new_session_id, final_state)
             return AgentResponse(
                 session_id=new_session_id,
                 status="pending_verification",
@@ -142,26 +222,95 @@ async def ask_agent(request: QueryRequest):
             )
 
     except Exception as e:
-        print(f" Unhandled Error during AGENT_APP.invoke: {e}")
+        print(f" Unhandled Error during AGENT_APP.ainvoke: {e}")
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
 
 
-def handle_verification_request(request: QueryRequest) -> AgentResponse:
+@app.post("/ask/stream", summary="Query the Agent (Streaming)")
+async def ask_agent_stream(request: QueryRequest):
+    """
+    Sends a natural language query to the agent and streams the answer as Server-Sent Events.
+    Write queries yield their verification message; approve them through /ask.
+    """
+    if not AGENT_APP or not ACTIVE_DATABASES:
+        raise HTTPException(
+            status_code=400,
+            detail="Agent is not initialized. Please call the /init endpoint first."
+        )
+
+    if not request.query:
+        raise HTTPException(status_code=400, detail="Query is required for new requests")
+
+    new_session_id = str(uuid.uuid4())
+    initial_state = {
+        "query": request.query,
+        "sql_query": None,
+        "database_name": None,
+        "response": "",
+        "intent": None,
+        "verification_status": None
+    }
+
+    decided_state = await decide_action(initial_state)
+
+    return StreamingResponse(
+        stream_agent_events(new_session_id, decided_state),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def format_sse(payload: dict) -> bytes:
+    """Formats a payload as a single Server-Sent Event."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+async def stream_agent_events(session_id: str, state: dict) -> AsyncIterator[bytes]:
+    """Routes the decided state like the graph does, streaming answer tokens for reads."""
+    route = requires_verification(state)
+
+    if route == "execute_sql":
+        try:
+            async for token in stream_sql_answer(state):
+                yield format_sse({"token": token})
+        except Exception as e:
+            print(f" Error while streaming answer: {e}")
+            yield format_sse({"error": f"An unexpected error occurred: {e}"})
+
+    elif route == "verify_human":
+        pending_state = prepare_verification_message(state)
+        try:
+            await save_session(session_id, pending_state)
+            yield format_sse({
+                "status": "pending_verification",
+                "response_message": pending_state.get("response", ""),
+                "proposed_sql": pending_state.get("sql_query"),
+                "database_name": pending_state.get("database_name")
+            })
+        except Exception as e:
+            print(f" Error while saving pending session: {e}")
+            yield format_sse({"error": f"An unexpected error occurred: {e}"})
+
+    else:
+        yield format_sse({"error": state.get("response", "")})
+
+    yield format_sse({"done": True, "session_id": session_id})
+
+
+async def handle_verification_request(request: QueryRequest) -> AgentResponse:
     """Helper function to re-enter the graph after human approval."""
     session_id = request.session_id
-    if session_id not in AGENT_SESSIONS:
+    pending_state = await pop_session(session_id)
+    if pending_state is None:
         raise HTTPException(status_code=404, detail="Session ID not found or expired.")
 
-    pending_state = AGENT_SESSIONS[session_id]
-
     print(f"---  Verification Request for Session: {session_id} ---")
 
     if request.verification_status and request.verification_status.lower() == "approved":
         pending_state["verification_status"] = "approved"
         print("[HIL] Human Approved! Re-entering graph to execute SQL.")
 
-        final_state = AGENT_APP.invoke(pending_state)
-        del AGENT_SESSIONS[session_id]
+        final_state = await AGENT_APP.ainvoke(pending_state)
 
         return AgentResponse(
             session_id=session_id,
@@ -171,7 +320,6 @@ def handle_verification_request(request: QueryRequest) -> AgentResponse:
 
     else:
         # Human rejected the write
-        del AGENT_SESSIONS[session_id]
         return AgentResponse(
             session_id=session_id,
             status="rejected",
@@ -0,0 +1,176 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+import cachetools
+
+# sentence-transformers is listed in requirements.txt; if it is missing the semantic
+# tier is disabled and only exact matches are cached.
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    np = None
+    SentenceTransformer = None
+
+# A generated action stored as (database_name, sql_query, intent, answer_template).
+CachedAction = Tuple[str, str, str, Optional[str]]
+
+# Parts of a query that end up as SQL literals: quoted strings, numbers and dates,
+# and words with capitals (names such as "Paris"). Embeddings barely see them.
+LITERAL_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\d+(?:[.,:/-]\d+)*|\b\w*[A-Z]\w*\b")
+
+def normalize_query(query: str) -> str:
+    """
+    Strips surrounding whitespace so trivial variants share a key. Case and inner
+    whitespace are kept: they may be part of a literal ("Paris" vs "paris").
+    """
+    return query.strip()
+
+def query_literals(query: str) -> Tuple[str, ...]:
+    """Returns the literal tokens of a query, in order, as they appear in it."""
+    return tuple(LITERAL_RE.findall(query))
+
+class ExactCache:
+    """
+    LRU cache of generated actions keyed by (normalized query, schema hash).
+    """
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Tuple[str, str], CachedAction]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str, schema_hash: str) -> Optional[CachedAction]:
+        key = (normalize_query(query), schema_hash)
+        with self._lock:
+            action = self._entries.get(key)
+            if action is not None:
+                self._entries.move_to_end(key)
+            return action
+
+    def put(self, query: str, schema_hash: str, action: CachedAction) -> None:
+        key = (normalize_query(query), schema_hash)
+        with self._lock:
+            self._entries[key] = action
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+class SemanticCache:
+    """
+    Cache that returns the action of the most similar previous query,
+    using cosine similarity over sentence embeddings.
+
+    The embedding model is uncased and nearly blind to numbers, so "top 5" and
+    "top 10" (or "Paris" and "paris") look identical to it. A hit is therefore
+    only accepted when both queries have exactly the same literal tokens.
+    """
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        threshold: float = 0.95,
+        maxsize: int = 1024
+    ):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.enabled = SentenceTransformer is not None
+        self._model = None
+        self._schema_hash: Optional[str] = None
+        self._embeddings = None
+        self._actions: list = []
+        self._literals: list = []
+        self._lock = threading.Lock()
+
+    def _embed(self, query: str):
+        # The model is loaded lazily so importing this module stays cheap.
+        with self._lock:
+            if self._model is None:
+                self._model = SentenceTransformer(self.model_name)
+        return self._model.encode([normalize_query(query)], normalize_embeddings=True)[0]
+
+    def _reset_if_stale(self, schema_hash: str) -> None:
+        # Entries generated against another schema are no longer valid.
+        if self._schema_hash != schema_hash:
+            self._schema_hash = schema_hash
+            self._embeddings = None
+            self._actions = []
+            self._literals = []
+
+    def get(self, query: str, schema_hash: str) -> Optional[CachedAction]:
+        if not self.enabled:
+            return None
+        try:
+            embedding = self._embed(query)
+        except Exception as e:
+            # A cache failure (e.g. the model cannot be downloaded) must not fail the query.
+            print(f"[SEMANTIC CACHE] Embedding failed, skipping cache: {e}")
+            return None
+        with self._lock:
+            self._reset_if_stale(schema_hash)
+            if self._embeddings is None:
+                return None
+            # Embeddings are normalized, so the dot product is the cosine similarity.
+            scores = self._embeddings @ embedding
+            literals = query_literals(query)
+            matching = np.array([entry == literals for entry in self._literals])
+            scores = np.where(matching, scores, -1.0)
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return self._actions[best]
+            return None
+
+    def put(self, query: str, schema_hash: str, action: CachedAction) -> None:
+        if not self.enabled:
+            return
+        try:
+            embedding = self._embed(query)
+        except Exception as e:
+            print(f"[SEMANTIC CACHE] Embedding failed, skipping cache: {e}")
+            return
+        with self._lock:
+            self._reset_if_stale(schema_hash)
+            if self._embeddings is None:
+                self._embeddings = embedding[np.newaxis, :]
+            else:
+                self._embeddings = np.vstack([self._embeddings, embedding])
+            self._actions.append(action)
+            self._literals.append(query_literals(query))
+            if len(self._actions) > self.maxsize:
+                self._embeddings = self._embeddings[1:]
+                self._actions.pop(0)
+                self._literals.pop(0)
+
+class ResultCache:
+    """
+    Short-lived cache of read query results keyed by (schema hash, database, SQL),
+    so identical reads within the TTL skip the database.
+
+    The cache lives in process memory, so invalidate() only clears the current worker.
+    With several uvicorn workers, the others can keep serving results from before a
+    write until their entries expire; the short TTL is what bounds that staleness.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: int = 60):
+        self._entries = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(schema_hash: str, database_name: str, sql: str) -> Tuple[str, str, str]:
+        # Only surrounding whitespace and a trailing semicolon are normalized: anything
+        # inside the statement may be part of a string literal and change the result.
+        return schema_hash, database_name, sql.strip().rstrip(";").rstrip()
+
+    def get(self, schema_hash: str, database_name: str, sql: str) -> Optional[Any]:
+        with self._lock:
+            return self._entries.get(self._key(schema_hash, database_name, sql))
+
+    def put(self, schema_hash: str, database_name: str, sql: str, result: Any) -> None:
+        with self._lock:
+            self._entries[self._key(schema_hash, database_name, sql)] = result
+
+    def invalidate(self, database_name: str) -> None:
+        """Drops every cached result of a database in this process, e.g. after a write to it."""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == database_name]:
+                self._entries.pop(key, None)